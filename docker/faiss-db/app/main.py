@@ -1,50 +1,462 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-import faiss, numpy as np, os, pathlib
+from typing import Literal
+import asyncio, base64, binascii, contextlib, hashlib
+import faiss, math, numpy as np, os, pathlib, threading
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 DIM         = int(os.getenv("EMBEDDING_DIM", 1536))
 INDEX_PATH  = pathlib.Path(os.getenv("FAISS_INDEX_PATH", "/app/data/index.faiss"))
+PENDING_PATH = INDEX_PATH.with_suffix(".pending.bin")
 INDEX_PATH.parent.mkdir(parents=True, exist_ok=True)
+OMP_THREADS = int(os.getenv("FAISS_OMP_THREADS", min(4, os.cpu_count() or 1)))
+# seconds between background flushes of the index to disk
+FLUSH_EVERY = float(os.getenv("FAISS_FLUSH_INTERVAL", 1.0))
+
+# concurrent searches each fan out over OpenMP; cap it to avoid oversubscription
+faiss.omp_set_num_threads(OMP_THREADS)
+
+INDEX_TYPE  = os.getenv("FAISS_INDEX_TYPE", "ivf").lower()      # ivf | ivfpq | hnsw | sq8
+HNSW_M      = int(os.getenv("FAISS_HNSW_M", 32))
+
+# IVF sizing: nlist ~ 2*sqrt(n) cells, probe a quarter of them (at most 10)
+EXPECTED_N  = int(os.getenv("FAISS_EXPECTED_VECTORS", 10_000))
+NLIST       = int(os.getenv("FAISS_NLIST", max(2 * int(math.sqrt(max(EXPECTED_N, 400))), 20)))
+NPROBE      = int(os.getenv("FAISS_NPROBE", max(min(NLIST // 4, 10), 1)))
+# IVFPQ: DIM split into PQ_M sub-vectors of PQ_NBITS-bit codes (PQ_M must divide DIM)
+PQ_M        = int(os.getenv("FAISS_PQ_M", 48))
+PQ_NBITS    = 8
+# vectors to collect before training; FAISS wants ~39 points per centroid,
+# and PQ needs at least 2**PQ_NBITS to fit its codebooks
+TRAIN_SIZE  = max(int(os.getenv("FAISS_TRAIN_SIZE", 39 * NLIST)), NLIST, 1 << PQ_NBITS)
+if INDEX_TYPE == "sq8":
+    # no centroids: a small sample is enough to fit the per-dimension ranges
+    TRAIN_SIZE = max(int(os.getenv("FAISS_TRAIN_SIZE", 1000)), 1)
+
+# serve the index from GPU 0; needs a faiss-gpu build instead of faiss-cpu
+USE_GPU     = os.getenv("FAISS_USE_GPU", "").lower() in ("1", "true", "yes")
+
+# HNSW graphs and GPU indexes cannot drop ids, so re-adding one keeps both entries
+# (search_unique hides the repeats)
+CAN_REMOVE  = INDEX_TYPE != "hnsw" and not USE_GPU
 
 # Initialise or load index ---------------------------------------------------
+def create_new_index() -> faiss.Index:
+    if INDEX_TYPE == "hnsw":
+        # graph search: O(log n) per query instead of a full linear scan
+        hnsw = faiss.IndexHNSWFlat(DIM, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        hnsw.hnsw.efConstruction = int(os.getenv("FAISS_HNSW_EF_CONSTRUCTION", 100))
+        hnsw.hnsw.efSearch       = int(os.getenv("FAISS_HNSW_EF_SEARCH", 64))
+        return faiss.IndexIDMap2(hnsw)
+    if INDEX_TYPE == "sq8":
+        # 8-bit scalar quantised flat scan: a quarter of float32's bytes per vector;
+        # needs training for the per-dimension ranges (see add_vectors)
+        sq = faiss.IndexScalarQuantizer(DIM, faiss.ScalarQuantizer.QT_8bit,
+                                        faiss.METRIC_INNER_PRODUCT)
+        return faiss.IndexIDMap2(sq)
+    quantizer = faiss.IndexFlatIP(DIM)
+    if INDEX_TYPE == "ivfpq":
+        # PQ codes: PQ_M bytes per vector instead of DIM * 4, distances via table lookups
+        index = faiss.IndexIVFPQ(quantizer, DIM, NLIST, PQ_M, PQ_NBITS,
+                                 faiss.METRIC_INNER_PRODUCT)
+    elif INDEX_TYPE == "ivf":
+        # IVF-Flat, trained on the first TRAIN_SIZE real vectors (see add_vectors)
+        index = faiss.IndexIVFFlat(quantizer, DIM, NLIST, faiss.METRIC_INNER_PRODUCT)
+    else:
+        raise ValueError(f"Unknown FAISS_INDEX_TYPE {INDEX_TYPE!r}")
+    index.nprobe = NPROBE
+    return index
+
+def to_gpu(cpu_index: faiss.Index) -> faiss.Index:
+    global gpu_resources                  # must outlive the GPU index
+    if not hasattr(faiss, "StandardGpuResources"):
+        raise RuntimeError("FAISS_USE_GPU is set but faiss was built without GPU support")
+    if INDEX_TYPE not in ("ivf", "ivfpq"):
+        # IDMap2-wrapped HNSW and flat SQ8 have no GPU counterpart
+        raise RuntimeError(f"FAISS_USE_GPU is set but {INDEX_TYPE!r} indexes have no GPU version")
+    gpu_resources = faiss.StandardGpuResources()
+    return faiss.index_cpu_to_gpu(gpu_resources, 0, cpu_index)
+
+def replace_file(path: pathlib.Path, write):
+    """Write ``path`` through a temp file, so a crash never leaves it truncated."""
+    tmp = path.with_name(path.name + ".tmp")
+    write(str(tmp))
+    os.replace(tmp, path)
+
+def index_type_of(ix: faiss.Index) -> str:
+    """The FAISS_INDEX_TYPE that builds an index like ``ix``."""
+    if isinstance(ix, faiss.IndexIDMap2):
+        ix = faiss.downcast_index(ix.index)
+    for cls, name in ((faiss.IndexHNSW, "hnsw"), (faiss.IndexScalarQuantizer, "sq8"),
+                      (faiss.IndexIVFPQ, "ivfpq"), (faiss.IndexIVFFlat, "ivf")):
+        if isinstance(ix, cls):
+            return name
+    return type(ix).__name__
+
 if INDEX_PATH.exists():
     index = faiss.read_index(str(INDEX_PATH))
+    # removal, training and GPU support all follow FAISS_INDEX_TYPE, so it must
+    # describe the index actually persisted in the volume
+    if index_type_of(index) != INDEX_TYPE:
+        raise RuntimeError(f"{INDEX_PATH} holds a {index_type_of(index)!r} index but "
+                           f"FAISS_INDEX_TYPE is {INDEX_TYPE!r}; set it to match or move the file away")
 else:
-    # IVF-Flat with 256 centroids
-    quantizer = faiss.IndexFlatIP(DIM)
-    index     = faiss.IndexIVFFlat(quantizer, DIM, 256, faiss.METRIC_INNER_PRODUCT)
-    index.nprobe = 10
-    index.train(np.random.random((1000, DIM)).astype("float32"))  # dummy train
-    faiss.write_index(index, str(INDEX_PATH))
+    index = create_new_index()
+    replace_file(INDEX_PATH, lambda tmp: faiss.write_index(index, tmp))
+if USE_GPU:
+    index = to_gpu(index)
+
+class Pending:
+    """Vectors waiting for an untrained index to be trained.
+
+    Rows live in one growable contiguous matrix, so searching the buffer needs
+    no copy, and are persisted as an append-only log of (id, vector) records.
+    """
+
+    RECORD = np.dtype([("id", "<i8"), ("vector", "<f4", (DIM,))])
+
+    def __init__(self):
+        self.ids      = np.empty(0, dtype="int64")
+        self.vecs     = np.empty((0, DIM), dtype="float32")
+        self.n        = 0
+        self._saved   = 0                 # rows already in PENDING_PATH
+        self._rewrite = False             # rows were removed: the log is stale
+
+    def __len__(self):
+        return self.n
+
+    def matrix(self) -> tuple[np.ndarray, np.ndarray]:
+        """Views of the live ids and rows."""
+        return self.ids[:self.n], self.vecs[:self.n]
+
+    def add(self, ids: np.ndarray, vecs: np.ndarray):
+        self.remove(ids)                  # re-adding an id replaces it
+        need = self.n + len(ids)
+        if need > len(self.ids):          # grow geometrically: amortised O(1) appends
+            cap = max(need, 2 * len(self.ids), 64)
+            self.ids  = np.resize(self.ids, cap)
+            self.vecs = np.resize(self.vecs, (cap, DIM))
+        self.ids[self.n:need]  = ids
+        self.vecs[self.n:need] = vecs
+        self.n = need
+
+    def remove(self, ids: np.ndarray) -> int:
+        live_ids, live_vecs = self.matrix()
+        hit = np.isin(live_ids, ids)
+        removed = int(hit.sum())
+        if removed:
+            keep = ~hit
+            self.n = self.n - removed
+            self.ids[:self.n], self.vecs[:self.n] = live_ids[keep], live_vecs[keep]
+            self._rewrite = True
+        return removed
+
+    def clear(self):
+        self.n = 0
+        self._rewrite = True
+
+    def load(self):
+        raw = PENDING_PATH.read_bytes()
+        # drop a record torn by a crash mid-append
+        records = np.frombuffer(raw[:len(raw) - len(raw) % self.RECORD.itemsize], dtype=self.RECORD)
+        # replay the log: a later record for an id replaces an earlier one
+        _, last = np.unique(records["id"][::-1], return_index=True)
+        records = records[np.sort(len(records) - 1 - last)]
+        self.add(records["id"], records["vector"])
+        self._rewrite = True              # compact the log on the next save
+
+    def save(self):
+        if not self.n:
+            PENDING_PATH.unlink(missing_ok=True)
+            self._saved, self._rewrite = 0, False
+            return
+        start = 0 if self._rewrite else self._saved
+        if start == self.n:
+            return
+        records = np.empty(self.n - start, dtype=self.RECORD)
+        records["id"], records["vector"] = self.ids[start:self.n], self.vecs[start:self.n]
+        if start:
+            with open(PENDING_PATH, "ab") as f:   # a torn append is dropped by load()
+                records.tofile(f)
+        else:
+            replace_file(PENDING_PATH, records.tofile)
+        self._saved, self._rewrite = self.n, False
+
+pending = Pending()
+if PENDING_PATH.exists():
+    if index.is_trained:
+        # save() crashed between its two writes: these rows are already in the index
+        PENDING_PATH.unlink()
+    else:
+        pending.load()
+
+# cancelling a flush does not stop its worker thread; never let two saves write at once
+save_lock = threading.Lock()
+
+def save():
+    with save_lock:
+        # GPU indexes have to be copied back to host memory to be serialised
+        cpu_index = faiss.index_gpu_to_cpu(index) if USE_GPU else index
+        replace_file(INDEX_PATH, lambda tmp: faiss.write_index(cpu_index, tmp))
+        pending.save()
 
 # ---------------------------------------------------------------------------
 
+class RWLock:
+    """Many concurrent readers (searches) or a single writer (index mutations).
+
+    CPU FAISS searches are safe to run in parallel, but adding to an index
+    while a search is in flight is not.
+    """
+
+    def __init__(self):
+        self._writer     = asyncio.Lock()
+        self._readers    = 0
+        self._no_readers = asyncio.Event()
+        self._no_readers.set()
+
+    @contextlib.asynccontextmanager
+    async def read(self):
+        async with self._writer:          # queue behind a waiting writer
+            self._readers += 1
+            self._no_readers.clear()
+        try:
+            yield
+        finally:
+            self._readers -= 1
+            if self._readers == 0:
+                self._no_readers.set()
+
+    @contextlib.asynccontextmanager
+    async def write(self):
+        async with self._writer:
+            await self._no_readers.wait()
+            yield
+
+index_lock = RWLock()
+
+def snapshot_lock():
+    """Lock for reading the index: shared on CPU, exclusive on GPU.
+
+    GPU indexes are not thread-safe even between searches, and copying one
+    back to host memory in save() must not overlap a search either.
+    """
+    return index_lock.write() if USE_GPU else index_lock.read()
+
+# set by mutations, cleared by flush(): disk writes are coalesced off the request path
+dirty = False
+# the save in flight, if any; mutations wait for the snapshot lock it holds,
+# so it covers every mutation that has already finished
+saving: asyncio.Future | None = None
+
+async def flush():
+    """Write pending changes to disk; returns once they are durable."""
+    global dirty, saving
+    if saving is not None:                # join it instead of queueing another save
+        return await asyncio.shield(saving)
+    if not dirty:
+        return
+    # writing a snapshot may overlap CPU searches, but not mutations
+    async with snapshot_lock():
+        if saving is not None:            # another flush took the shared lock first
+            return await asyncio.shield(saving)
+        if not dirty:
+            return
+        saving = asyncio.ensure_future(asyncio.to_thread(save))
+        try:
+            await asyncio.shield(saving)
+            dirty = False
+        finally:
+            saving = None
+
+async def flush_forever():
+    while True:
+        await asyncio.sleep(FLUSH_EVERY)
+        await flush()
+
+def to_faiss_id(doc_id: str) -> int:
+    # stable across restarts, unlike the per-process salted built-in hash()
+    digest = hashlib.blake2b(doc_id.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") & ((1 << 63) - 1)
+
+def as_matrix(rows: list[list[float]]) -> np.ndarray:
+    """Turn request vectors into a (n, DIM) float32 matrix, rejecting bad input."""
+    if not rows:
+        return np.empty((0, DIM), dtype="float32")
+    try:
+        vecs = np.asarray(rows, dtype="float32")
+    except ValueError:                    # ragged rows
+        vecs = None
+    # one vectorised pass instead of a per-element Python check
+    if vecs is None or vecs.shape[1:] != (DIM,) or not np.isfinite(vecs).all():
+        raise HTTPException(status_code=400,
+                            detail=f"Vectors must have {DIM} finite components")
+    return vecs
+
+def ntotal() -> int:
+    return index.ntotal + len(pending)
+
+def remove_ids(ids: np.ndarray) -> int:
+    """Drop ``ids`` from the index in place; returns how many were removed."""
+    removed = pending.remove(ids)
+    try:
+        return removed + index.remove_ids(ids)
+    except RuntimeError as e:             # index type without removal support
+        raise HTTPException(status_code=400, detail=f"Cannot remove ids: {e}")
+
+def add_vectors(ids: np.ndarray, vecs: np.ndarray) -> bool:
+    """Add rows to the index, or buffer them while it is still untrained.
+
+    Returns True once enough vectors are buffered to train the index.
+    """
+    # re-adding an id replaces it instead of leaving a stale duplicate
+    if CAN_REMOVE:
+        remove_ids(ids)
+    if index.is_trained:
+        index.add_with_ids(vecs, ids)
+        return False
+    pending.add(ids, vecs)
+    return len(pending) >= TRAIN_SIZE
+
+def train_pending():
+    ids, vecs = pending.matrix()
+    index.train(vecs)
+    index.add_with_ids(vecs, ids)
+    pending.clear()
+
+def top_k(scores: np.ndarray, ids: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Best ``k`` hits as (1, k) rows, padded with -1 ids like a short FAISS result."""
+    best = np.argsort(-scores, kind="stable")[:k]
+    D = np.full((1, k), -np.finfo("float32").max, dtype="float32")
+    I = np.full((1, k), -1, dtype="int64")
+    D[0, :len(best)], I[0, :len(best)] = scores[best], ids[best]
+    return D, I
+
+def search_unique(vec: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """index.search, minus repeat hits for ids re-added to an index without removal.
+
+    Over-fetches until ``k`` distinct ids are found; each keeps its best score.
+    """
+    if CAN_REMOVE:
+        return index.search(vec, k)
+    n = 2 * k
+    while True:
+        D, I = index.search(vec, n)
+        found = I[0] >= 0
+        ids, first = np.unique(I[0][found], return_index=True)
+        if len(ids) >= k or found.sum() < n:      # enough hits, or the index ran out
+            return top_k(D[0][found][first], ids, k)
+        n *= 2
+
+def search_pending(vec: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Exact inner-product search over the vectors buffered before training."""
+    ids, vecs = pending.matrix()
+    # padded to k like a trained index, so the response shape does not change
+    return top_k(vecs @ vec[0], ids, k)
+
 class Vector(BaseModel):
     id: str
-    vector: list[float]
+    vector: list[float] | None = None
+    # compact alternative to `vector`: base64 of the little-endian array;
+    # int8 rows are symmetric-quantised and multiplied back by `scale`
+    vector_b64: str | None = None
+    dtype: Literal["float32", "float16", "int8"] = "float32"
+    scale: float = 1.0
+
+class AddBatch(BaseModel):
+    items: list[Vector]
+
+class DocId(BaseModel):
+    id: str
 
 class Query(BaseModel):
     vector: list[float]
     k: int = 5
 
+WIRE_DTYPES = {"float32": "<f4", "float16": "<f2", "int8": "i1"}
+
+def vector_of(v: Vector) -> np.ndarray | list[float]:
+    """The raw row sent in ``v``, either as JSON floats or as base64 bytes."""
+    if v.vector_b64 is None:
+        if v.vector is None:
+            raise HTTPException(status_code=400, detail="Either vector or vector_b64 is required")
+        return v.vector
+    try:
+        raw = base64.b64decode(v.vector_b64, validate=True)
+        vec = np.frombuffer(raw, dtype=WIRE_DTYPES[v.dtype])
+    except (binascii.Error, ValueError):  # bad base64, or not a whole number of items
+        raise HTTPException(status_code=400, detail="Malformed vector_b64")
+    return vec.astype("float32") * v.scale if v.dtype == "int8" else vec
+
+@app.on_event("startup")
+async def start_flusher():
+    app.state.flusher = asyncio.create_task(flush_forever())
+
+@app.on_event("shutdown")
+async def stop_flusher():
+    # uvicorn turns SIGTERM into a shutdown, so pending writes land here
+    app.state.flusher.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await app.state.flusher
+    await flush()
+
 @app.get("/ping")
 async def ping():
     return {"ping": "pong"}
 
 @app.post("/add")
-async def add(v: Vector):
-    vec = np.asarray(v.vector, dtype="float32").reshape(1, -1)
-    ids = np.asarray([abs(hash(v.id)) % (1 << 63)], dtype="int64")
-    index.add_with_ids(vec, ids)
-    faiss.write_index(index, str(INDEX_PATH))
-    return {"stored": True, "ntotal": index.ntotal}
+async def add(v: Vector, durable: bool = False):
+    global dirty
+    vec = as_matrix([vector_of(v)])
+    ids = np.asarray([to_faiss_id(v.id)], dtype="int64")
+    # remove_ids scans every inverted list, so keep it off the event loop too
+    async with index_lock.write():
+        if await asyncio.to_thread(add_vectors, ids, vec):
+            await asyncio.to_thread(train_pending)
+        dirty = True
+    # durable=true: acknowledge only once the vector is on disk, not at the next flush
+    if durable:
+        await flush()
+    return {"stored": True, "ntotal": ntotal()}
+
+@app.post("/add_batch")
+async def add_batch(b: AddBatch, durable: bool = False):
+    global dirty
+    # one index add for the whole batch
+    vecs = as_matrix([vector_of(v) for v in b.items])
+    ids  = np.fromiter((to_faiss_id(v.id) for v in b.items), dtype="int64", count=len(b.items))
+    # an id repeated within the batch keeps its last row, as sequential /add calls would
+    _, last = np.unique(ids[::-1], return_index=True)
+    keep = np.sort(len(ids) - 1 - last)
+    ids, vecs = ids[keep], vecs[keep]
+    async with index_lock.write():
+        if await asyncio.to_thread(add_vectors, ids, vecs):
+            await asyncio.to_thread(train_pending)
+        dirty = True
+    if durable:
+        await flush()
+    return {"stored": len(ids), "ntotal": ntotal()}
+
+@app.post("/delete")
+async def delete(d: DocId):
+    global dirty
+    ids = np.asarray([to_faiss_id(d.id)], dtype="int64")
+    async with index_lock.write():
+        removed = await asyncio.to_thread(remove_ids, ids)
+        dirty   = dirty or bool(removed)
+    return {"deleted": bool(removed), "ntotal": ntotal()}
 
 @app.post("/search")
 async def search(q: Query):
-    if index.ntotal == 0:
-        raise HTTPException(status_code=400, detail="Index is empty")
-    vec = np.asarray(q.vector, dtype="float32").reshape(1, -1)
-    D, I = index.search(vec, q.k)
-    return {"ids": I.tolist()[0], "distances": D.tolist()[0]}
+    vec = as_matrix([q.vector])
+    # index.search releases the GIL, so run it off the event loop
+    async with snapshot_lock():
+        # checked under the lock: a concurrent /delete may have emptied the index
+        if ntotal() == 0:
+            raise HTTPException(status_code=400, detail="Index is empty")
+        search_fn = search_unique if index.is_trained else search_pending
+        D, I = await asyncio.to_thread(search_fn, vec, q.k)
+    # ORJSONResponse serialises the numpy rows directly, no .tolist() needed
+    return ORJSONResponse({"ids": I[0], "distances": D[0]})